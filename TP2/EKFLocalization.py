@@ -4,7 +4,7 @@ TP Kalman filter for mobile robots localization
 authors: Goran Frehse, David Filliat, Nicolas Merlinge
 """
 
-from math import sin, cos, atan2, pi, sqrt
+from math import sin, cos, atan2, pi, sqrt, hypot
 import matplotlib.pyplot as plt
 import numpy as np
 seed = 123456
@@ -29,6 +29,15 @@ class Simulation:
         self.Map = Map
         self.RTrue = RTrue # true sensor noise
         self.dt_meas = dt_meas # time between two measurements
+        self.sqrtQ = np.linalg.cholesky(QTrue) # noise shaping matrices, constant over time
+        self.sqrtR = np.linalg.cholesky(RTrue)
+
+        # Pre-generated noises and observed features, for random repetability without reseeding
+        rng_odom = np.random.default_rng(seed*2)
+        rng_obs = np.random.default_rng(seed*3)
+        self.odom_noise = rng_odom.standard_normal((self.nSteps, 3))
+        self.obs_noise = rng_obs.standard_normal((self.nSteps, 2))
+        self.feat_idx = rng_obs.integers(0, Map.shape[1] - 1, size=self.nSteps) # upper bound excluded: 0 to nLandmarks-2
         
     # return true control at step k
     def get_robot_control(self, k):
@@ -47,15 +56,11 @@ class Simulation:
     
     # computes and returns noisy odometry
     def get_odometry(self, k):
-        # Ensuring random repetability for given k
-        np.random.seed(seed*2 + k)
-        
         # Model
         dt_pred = self.dt_pred
         u = self.get_robot_control(k)
         xnow = tcomp(self.xOdom, u, dt_pred) # odometry robot position with the control
-        uNoise = np.sqrt(self.QTrue) @ np.random.randn(3)
-        uNoise = np.array([uNoise]).T
+        uNoise = (self.sqrtQ @ self.odom_noise[k]).reshape(3, 1)
         xnow = tcomp(xnow, uNoise, dt_pred)
         self.xOdom = xnow # update odometry position
         u = u + dt_pred*uNoise  # add noise to control
@@ -64,9 +69,6 @@ class Simulation:
 
     # generate a noisy observation of a random feature
     def get_observation(self, k):
-        # Ensuring random repetability for given k
-        np.random.seed(seed*3 + k)
-
         # Model
         if k*self.dt_pred % self.dt_meas == 0:
             notValidCondition = False # False: measurement valid / True: measurement not valid
@@ -75,9 +77,8 @@ class Simulation:
                 z = None
                 iFeature = None
             else:
-                iFeature = np.random.randint(0, self.Map.shape[1] - 1) # random feature index to observe (0 to nLandmarks-1)
-                zNoise = np.sqrt(self.RTrue) @ np.random.randn(2) # noise on the observation
-                zNoise = np.array([zNoise]).T # noise on the observation
+                iFeature = self.feat_idx[k] # random feature index to observe (0 to nLandmarks-2)
+                zNoise = (self.sqrtR @ self.obs_noise[k]).reshape(2, 1) # noise on the observation
                 z = observation_model(self.xTrue, iFeature, self.Map) + zNoise  # true observation with noise
                 z[1, 0] = angle_wrap(z[1, 0])
         else:
@@ -113,7 +114,7 @@ def observation_model(xVeh, iFeature, Map):
     dx = Map[0, iFeature] - xVeh[0, 0] # Difference between x coordenate of the robot and characteristic
     dy = Map[1, iFeature] - xVeh[1, 0]
     z = np.zeros((2, 1))  #Distance and angle to the characteristic
-    z[0, 0] = sqrt(dx**2 + dy**2)
+    z[0, 0] = hypot(dx, dy)
     z[1, 0] = atan2(dy, dx) - xVeh[2, 0]
     z[1, 0] = angle_wrap(z[1, 0])
     return z
@@ -131,14 +132,13 @@ def get_obs_jac(xPred, iFeature, Map):
     # Difference between x coordenate of the robot and characteristic
     dx = Map[0, iFeature] - xPred[0, 0] 
     dy = Map[1, iFeature] - xPred[1, 0]
-    q = sqrt(dx ** 2 + dy ** 2)
+    q2 = dx * dx + dy * dy
+    q = sqrt(q2)
     
     # jH is a 2x3 matrix containing the partial derivatives of the observation function with respect to the robot’s state variables.
-    jH = np.zeros((2, 3)) # It will conatiane the partial derivates of the observation's function respect the robot's state
-    
     jH = np.array([
         [-dx / q, -dy / q, 0],  # Pour rk
-        [dy / (dx ** 2 + dy ** 2), -dx / (dx ** 2 + dy ** 2), -1]  # Pour phik
+        [dy / q2, -dx / q2, -1]  # Pour phik
     ])
 
     return jH
@@ -185,11 +185,76 @@ def G(x, u, dt_pred):
     return Jac
 
 
+# ---- Kalman Filter: fused model and Jacobian functions ----
+# The functions above are the TP reference implementations; the filter loop uses the fused
+# versions below, which are checked against them by check_fused_models at startup.
+
+# f(x,u) with its Jacobians wrt x and w, sharing the same trigonometry
+def predict_step(x, u, dt_pred, F_x, G_u):
+    # x: estimated state (x, y, heading)
+    # u: control input (Vx, Vy, angular rate)
+    # dt_pred: time step
+    # F_x, G_u: preallocated 3x3 Jacobians, only their state dependent terms are written
+
+    x0, x1, theta = x[0, 0], x[1, 0], x[2, 0]
+    u0, u1, u2 = u[0, 0], u[1, 0], u[2, 0]
+    c = cos(theta) * dt_pred
+    s = sin(theta) * dt_pred
+
+    xPred = np.array([[x0 + u0 * c - u1 * s],
+                      [x1 + u0 * s + u1 * c],
+                      [angle_wrap(theta + u2 * dt_pred)]])
+    F_x[0, 2] = - u0 * s - u1 * c
+    F_x[1, 2] = u0 * c - u1 * s
+    G_u[0, 0] = c
+    G_u[0, 1] = -s
+    G_u[1, 0] = s
+    G_u[1, 1] = c
+    return xPred
+
+
+# h(x) with its Jacobian wrt x, sharing the same range computation
+def observe_step(xPred, iFeature, Map):
+    # xPred: predicted state
+    # iFeature: observed amer index
+    # Map: map of all amers
+
+    dx = Map[0, iFeature] - xPred[0, 0]
+    dy = Map[1, iFeature] - xPred[1, 0]
+    q2 = dx * dx + dy * dy
+    q = sqrt(q2)
+
+    zPred = np.array([[q],
+                      [angle_wrap(atan2(dy, dx) - xPred[2, 0])]])
+    H = np.array([[-dx / q, -dy / q, 0],
+                  [dy / q2, -dx / q2, -1]])
+    return zPred, H
+
+
+# check that the fused functions match the reference model and Jacobian functions
+def check_fused_models(x, u, dt_pred, iFeature, Map):
+    F_x = np.eye(3)
+    G_u = np.diag([0, 0, dt_pred]).astype(float)
+    xPred = predict_step(x, u, dt_pred, F_x, G_u)
+    assert np.allclose(xPred, motion_model(x, u, dt_pred))
+    assert np.allclose(F_x, F(x, u, dt_pred))
+    assert np.allclose(G_u, G(x, u, dt_pred))
+
+    zPred, H = observe_step(x, iFeature, Map)
+    assert np.allclose(zPred, observation_model(x, iFeature, Map))
+    assert np.allclose(H, get_obs_jac(x, iFeature, Map))
+
+
 # ---- Utils functions ----
 # Display error ellipses
-def plot_covariance_ellipse(xEst, PEst, axes, lineType):
+ELLIPSE_T = np.linspace(0, 2 * pi, 64)  # ellipse parametrization, constant
+ELLIPSE_COS = np.cos(ELLIPSE_T)
+ELLIPSE_SIN = np.sin(ELLIPSE_T)
+
+def plot_covariance_ellipse(xEst, PEst, axes, lineType, line=None):
     """
     Plot one covariance ellipse from covariance matrix
+    (updates the given line instead of creating a new one if provided)
     """
 
     Pxy = PEst[0:2, 0:2]
@@ -206,27 +271,34 @@ def plot_covariance_ellipse(xEst, PEst, axes, lineType):
         print('Pb with Pxy :\n', Pxy)
         exit()
 
-    t = np.arange(0, 2 * pi + 0.1, 0.1)
     a = sqrt(eigval[bigind])
     b = sqrt(eigval[smallind])
-    x = [3 * a * cos(it) for it in t]
-    y = [3 * b * sin(it) for it in t]
+    x = 3 * a * ELLIPSE_COS
+    y = 3 * b * ELLIPSE_SIN
     angle = atan2(eigvec[bigind, 1], eigvec[bigind, 0])
     rot = np.array([[cos(angle), sin(angle)],
                     [-sin(angle), cos(angle)]])
-    fx = rot @ (np.array([x, y]))
+    fx = rot @ np.vstack((x, y))
     px = np.array(fx[0, :] + xEst[0, 0]).flatten()
     py = np.array(fx[1, :] + xEst[1, 0]).flatten()
-    axes.plot(px, py, lineType)
+    if line is None:
+        line, = axes.plot(px, py, lineType)
+    else:
+        line.set_data(px, py)
+    return line
+
 
+# closed-form inverse of a 2x2 matrix
+def inv2(M):
+    a, b = M[0]
+    c, d = M[1]
+    det = a * d - b * c
+    return np.array([[d, -b], [-c, a]]) / det
 
-# fit angle between -pi and pi
+
+# fit angle (or array of angles) between -pi and pi
 def angle_wrap(a):
-    if (a > np.pi):
-        a = a - 2 * pi
-    elif (a < -np.pi):
-        a = a + 2 * pi
-    return a
+    return (a + pi) % (2 * pi) - pi
 
 
 # composes two transformations
@@ -235,13 +307,16 @@ def tcomp(tab, tbc, dt):
     assert tbc.ndim == 2 # eg: robot control [Vx, Vy, angle rate]
     #dt : time-step (s)
 
-    angle = tab[2, 0] + dt * tbc[2, 0] # angular integration by Euler
+    # scalar computations, a single array is built for the output
+    x, y, theta = tab[0, 0], tab[1, 0], tab[2, 0]
+    vx, vy, omega = tbc[0, 0], tbc[1, 0], tbc[2, 0]
 
-    angle = angle_wrap(angle)
-    s = sin(tab[2, 0])
-    c = cos(tab[2, 0])
-    position = tab[0:2] + dt * np.array([[c, -s], [s, c]]) @ tbc[0:2] # position integration by Euler
-    out = np.vstack((position, angle))
+    angle = angle_wrap(theta + dt * omega) # angular integration by Euler
+    s = sin(theta)
+    c = cos(theta)
+    out = np.array([[x + dt * (c * vx - s * vy)], # position integration by Euler
+                    [y + dt * (s * vx + c * vy)],
+                    [angle]])
 
     return out
 
@@ -284,17 +359,73 @@ xOdom = xTrue
 xEst = xTrue
 PEst = 10 * np.diag([1, 1, (1*pi/180)**2])
 
-# Init history matrixes
-hxEst = xEst
-hxTrue = xTrue
-hxOdom = xOdom
-hxError = np.abs(xEst-xTrue)  # pose error
-hxVar = np.sqrt(np.diag(PEst).reshape(3, 1))  # state std dev
-htime = [0]
-
 # Simulation environment
 simulation = Simulation(Tf, dt_pred, xTrue, QTrue, xOdom, Map, RTrue, dt_meas)
 
+# Init history matrixes
+hxEst = np.empty((3, simulation.nSteps))
+hxTrue = np.empty((3, simulation.nSteps))
+hxOdom = np.empty((3, simulation.nSteps))
+hxError = np.empty((3, simulation.nSteps))  # pose error
+hxVar = np.empty((3, simulation.nSteps))  # state std dev
+htime = np.empty(simulation.nSteps)
+hxEst[:, 0] = xEst[:, 0]
+hxTrue[:, 0] = xTrue[:, 0]
+hxOdom[:, 0] = xOdom[:, 0]
+hxError[:, 0] = np.abs(xEst-xTrue)[:, 0]
+hxVar[:, 0] = np.sqrt(np.diag(PEst))
+htime[0] = 0
+
+# Init plots: artists are created once and only their data is updated in the loop
+if show_animation:
+    # for stopping simulation with the esc key.
+    f.canvas.mpl_connect('key_release_event',
+                lambda event: [exit(0) if event.key == 'escape' else None])
+
+    # Plot true landmark and trajectory
+    ax1.plot(Map[0, :], Map[1, :], "*k")
+    line_true, = ax1.plot([], [], "-k", label="True")
+
+    # Plot odometry trajectory
+    line_odom, = ax1.plot([], [], "-g", label="Odom")
+
+    # Plot estimated trajectory an pose covariance
+    line_est, = ax1.plot([], [], "-r", label="EKF")
+    point_est, = ax1.plot([], [], ".r")
+    line_ellipse = None
+
+    ax1.axis([-70, 70, -70, 70])
+    ax1.grid(True)
+    ax1.legend()
+
+    # plot errors curves
+    err_lines = []
+    for ax in (ax3, ax4, ax5):
+        line_err, = ax.plot([], [], 'b')
+        line_up, = ax.plot([], [], 'r')
+        line_down, = ax.plot([], [], 'r')
+        # ax.axvline(x=2500, color='g', linestyle='--')
+        # ax.axvline(x=3500, color='g', linestyle='--')
+        ax.grid(True)
+        err_lines.append((ax, line_err, line_up, line_down))
+    ax3.set_ylabel('x')
+    ax3.set_xlabel('time (s)')
+    ax3.set_title(r'Real error (blue) and 3 $\sigma$ covariances (red)')
+    ax4.set_ylabel('y')
+    ax5.set_ylabel(r"$\theta$")
+    ax5.set_xlabel('time (s)')
+
+check_fused_models(xEst, np.array([[0.1, 0.025, 0.01]]).T, simulation.dt_pred, 0, Map)
+
+I3 = np.eye(3)
+
+# Prediction buffers, reused at every step
+F_buf = np.eye(3)
+G_buf = np.diag([0, 0, simulation.dt_pred]).astype(float)
+tmp33 = np.empty((3, 3))
+tmp33b = np.empty((3, 3))
+PPred = np.empty((3, 3))
+
 # Temporal loop
 for k in range(1, simulation.nSteps):
 
@@ -305,47 +436,48 @@ for k in range(1, simulation.nSteps):
     xOdom, u_tilde = simulation.get_odometry(k)
 
     # Kalman prediction
-    xPred = motion_model(xEst, u_tilde, simulation.dt_pred)  # function f
-    F_x = F(xEst, u_tilde, simulation.dt_pred)
-    G_u = G(xEst, u_tilde, simulation.dt_pred)
-    PPred = F_x @ PEst @ F_x.T + G_u @ QEst @ G_u.T # PPred es la matriz de covarianza predicha del estado en el filtro de Kalman extendido.
+    xPred = predict_step(xEst, u_tilde, simulation.dt_pred, F_buf, G_buf)  # function f and its Jacobians
+    # PPred = F_x @ PEst @ F_x.T + G_u @ QEst @ G_u.T, la matriz de covarianza predicha del estado
+    np.matmul(F_buf, PEst, out=tmp33)
+    np.matmul(tmp33, F_buf.T, out=PPred)  # PEst is fully consumed before PPred is overwritten
+    np.matmul(G_buf, QEst, out=tmp33b)
+    np.matmul(tmp33b, G_buf.T, out=tmp33)
+    PPred += tmp33
 
     # Get random landmark observation
     [z, iFeature] = simulation.get_observation(k)
 
     if z is not None:
-        # Predict observation
-        zPred = observation_model(xPred, iFeature, Map)
-
-        # get observation Jacobian
-        H = get_obs_jac(xPred, iFeature, Map)
+        # Predict observation and get observation Jacobian
+        zPred, H = observe_step(xPred, iFeature, Map)
 
         # compute Kalman gain - with dir and distance
         Innov = z - zPred         # observation error (innovation)
         Innov[1, 0] = angle_wrap(Innov[1, 0])
         S =  REst + H @ PPred @ H.T
-        K = PPred @ H.T @ np.linalg.inv(S)
+        K = PPred @ H.T @ inv2(S)
 
         
         # Compute Kalman gain to use only distance
         # Innov = z[0:1, :] - zPred[0:1, :]  # observation error (innovation)
         # H = H[0:1, :]
         # S = H @ PPred @ H.T + REst[0:1, 0:1]
-        # K = PPred @ H.T @ np.linalg.inv(S)
+        # K = PPred @ H.T / S  # S is 1x1
 
         # Compute Kalman gain to use only direction
         # Innov = z[1:2, :] - zPred[1:2, :]  # observation error (innovation)
         # Innov[0, 0] = angle_wrap(Innov[0, 0])
         # H = H[1:2, :]
         # S = H @ PPred @ H.T + simulation.RTrue[1:2, 1:2]
-        # K = PPred @ H.T @ np.linalg.inv(S)
+        # K = PPred @ H.T / S  # S is 1x1
 
         # perform kalman update
         xEst =  xPred + K @ Innov
         xEst[2, 0] = angle_wrap(xEst[2, 0])
 
-        PEst = (np.eye(len(xEst)) - K @ H) @ PPred
-        PEst = 0.5 * (PEst + PEst.T)  # ensure symetry
+        # Joseph form: symmetric and positive by construction
+        IKH = I3 - K @ H
+        PEst = IKH @ PPred @ IKH.T + K @ REst @ K.T
 
     else:
         # there was no observation available
@@ -353,71 +485,34 @@ for k in range(1, simulation.nSteps):
         PEst = PPred
 
     # store data history
-    hxTrue = np.hstack((hxTrue, simulation.xTrue))
-    hxOdom = np.hstack((hxOdom, simulation.xOdom))
-    hxEst = np.hstack((hxEst, xEst))
+    hxTrue[:, k] = simulation.xTrue[:, 0]
+    hxOdom[:, k] = simulation.xOdom[:, 0]
+    hxEst[:, k] = xEst[:, 0]
     err = xEst - simulation.xTrue
     err[2, 0] = angle_wrap(err[2, 0])
-    hxError = np.hstack((hxError, err))
-    hxVar = np.hstack((hxVar, np.sqrt(np.diag(PEst).reshape(3, 1))))
-    htime.append(k*simulation.dt_pred)
+    hxError[:, k] = err[:, 0]
+    hxVar[:, k] = np.sqrt(np.diag(PEst))
+    htime[k] = k*simulation.dt_pred
 
     # plot every 15 updates
     if show_animation and k*simulation.dt_pred % 200 == 0:
-        # for stopping simulation with the esc key.
-        plt.gcf().canvas.mpl_connect('key_release_event',
-                    lambda event: [exit(0) if event.key == 'escape' else None])
+        times = htime[:k+1]
+
+        # Update trajectories, pose and pose covariance
+        line_true.set_data(hxTrue[0, :k+1], hxTrue[1, :k+1])
+        line_odom.set_data(hxOdom[0, :k+1], hxOdom[1, :k+1])
+        line_est.set_data(hxEst[0, :k+1], hxEst[1, :k+1])
+        point_est.set_data(xEst[0], xEst[1])
+        line_ellipse = plot_covariance_ellipse(xEst, PEst, ax1, "--r", line_ellipse)
+
+        # Update errors curves
+        for i, (ax, line_err, line_up, line_down) in enumerate(err_lines):
+            line_err.set_data(times, hxError[i, :k+1])
+            line_up.set_data(times, 3.0 * hxVar[i, :k+1])
+            line_down.set_data(times, -3.0 * hxVar[i, :k+1])
+            ax.relim()
+            ax.autoscale_view()
 
-        ax1.cla()
-        
-        times = np.stack(htime)
-
-        # Plot true landmark and trajectory
-        ax1.plot(Map[0, :], Map[1, :], "*k")
-        ax1.plot(hxTrue[0, :], hxTrue[1, :], "-k", label="True")
-
-        # Plot odometry trajectory
-        ax1.plot(hxOdom[0, :], hxOdom[1, :], "-g", label="Odom")
-
-        # Plot estimated trajectory an pose covariance
-        ax1.plot(hxEst[0, :], hxEst[1, :], "-r", label="EKF")
-        ax1.plot(xEst[0], xEst[1], ".r")
-        plot_covariance_ellipse(xEst,
-                                PEst, ax1, "--r")
-
-        ax1.axis([-70, 70, -70, 70])
-        ax1.grid(True)
-        ax1.legend()
-
-        # plot errors curves
-        ax3.plot(times, hxError[0, :], 'b')
-        ax3.plot(times, 3.0 * hxVar[0, :], 'r')
-        ax3.plot(times, -3.0 * hxVar[0, :], 'r')
-        # ax3.axvline(x=2500, color='g', linestyle='--')
-        # ax3.axvline(x=3500, color='g', linestyle='--')
-        ax3.grid(True)
-        ax3.set_ylabel('x')
-        ax3.set_xlabel('time (s)')
-        ax3.set_title('Real error (blue) and 3 $\sigma$ covariances (red)')
-
-        ax4.plot(times, hxError[1, :], 'b')
-        ax4.plot(times, 3.0 * hxVar[1, :], 'r')
-        ax4.plot(times, -3.0 * hxVar[1, :], 'r')
-        # ax4.axvline(x=2500, color='g', linestyle='--')
-        # ax4.axvline(x=3500, color='g', linestyle='--')
-        ax4.grid(True)
-        ax4.set_ylabel('y')
-        ax5.set_xlabel('time (s)')
-
-        ax5.plot(times, hxError[2, :], 'b')
-        ax5.plot(times, 3.0 * hxVar[2, :], 'r')
-        ax5.plot(times, -3.0 * hxVar[2, :], 'r')
-        # ax5.axvline(x=2500, color='g', linestyle='--')
-        # ax5.axvline(x=3500, color='g', linestyle='--')
-        ax5.grid(True)
-        ax5.set_ylabel(r"$\theta$")
-        ax5.set_xlabel('time (s)')
-        
         if save: plt.savefig(r'outputs/EKF_' + str(k) + '.png')
 #        plt.pause(0.001)
 
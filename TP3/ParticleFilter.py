@@ -4,7 +4,7 @@ TP particle filter for mobile robots localization
 authors: Goran Frehse, David Filliat, Nicolas Merlinge
 """
 
-from math import sin, cos, atan2, pi
+from math import sin, cos, pi
 import matplotlib as mpl 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -31,6 +31,15 @@ class Simulation:
         self.Map = Map
         self.RTrue = RTrue
         self.dt_meas = dt_meas
+        self.sqrtQ = np.linalg.cholesky(QTrue) # noise shaping matrices, constant over time
+        self.sqrtR = np.linalg.cholesky(RTrue)
+
+        # Pre-generated noises and observed features, for random repetability without reseeding
+        rng_odom = np.random.default_rng(seed*2)
+        rng_obs = np.random.default_rng(seed*3)
+        self.odom_noise = rng_odom.standard_normal((self.nSteps, 3))
+        self.obs_noise = rng_obs.standard_normal((self.nSteps, 2))
+        self.feat_idx = rng_obs.integers(0, Map.shape[1] - 1, size=self.nSteps) # upper bound excluded: 0 to nLandmarks-2
         
     # return true control at step k
     def get_robot_control(self, k):
@@ -49,15 +58,11 @@ class Simulation:
     
     # computes and returns noisy odometry
     def get_odometry(self, k):
-        # Ensuring random repetability for given k
-        np.random.seed(seed*2 + k)
-        
         # Model
         dt_pred = self.dt_pred
         u = self.get_robot_control(k)
         xnow = tcomp(self.xOdom, u, dt_pred)
-        uNoise = np.sqrt(self.QTrue) @ np.random.randn(3)
-        uNoise = np.array([uNoise]).T
+        uNoise = (self.sqrtQ @ self.odom_noise[k]).reshape(3, 1)
         xnow = tcomp(xnow, uNoise, dt_pred)
         self.xOdom = xnow
         u_tilda = u + dt_pred*uNoise
@@ -66,9 +71,6 @@ class Simulation:
 
     # generate a noisy observation of a random feature
     def get_observation(self, k):
-        # Ensuring random repetability for given k
-        np.random.seed(seed*3 + k)
-
         # Model
         if k*self.dt_pred % self.dt_meas == 0:
             notValidCondition = False # False: measurement valid / True: measurement not valid
@@ -81,9 +83,8 @@ class Simulation:
                 z = None
                 iFeature = None
             else:
-                iFeature = np.random.randint(0, self.Map.shape[1] - 1)
-                zNoise = np.sqrt(self.RTrue) @ np.random.randn(2)
-                zNoise = np.array([zNoise]).T
+                iFeature = self.feat_idx[k]
+                zNoise = (self.sqrtR @ self.obs_noise[k]).reshape(2, 1)
                 z = observation_model(self.xTrue, iFeature, self.Map) + zNoise
                 z[1, 0] = angle_wrap(z[1, 0])
         else:
@@ -97,45 +98,78 @@ class Simulation:
 
 
 # evolution model (f)
-def motion_model(x, u_tilda, dt_pred, QEst):
-    # x: estimated state (x, y, heading)
+def motion_model(x, u_tilda, dt_pred, QEst_chol):
+    # x: particles states (x, y, heading), one column per particle
     # u_tilda: noised control input (Vx, Vy, angular rate)
+    # QEst_chol: Cholesky factor of the modeled control noise covariance
+    
+    # rows of x are contiguous x, y and heading vectors, updated in place
+    px, py, pth = x
+    w_k = QEst_chol @ np.random.randn(3, px.size)
     
-    x_pos, y_pos, theta = x[0, 0], x[1, 0], x[2, 0]
-    Vx, Vy, omega = u_tilda[0, 0], u_tilda[1, 0], u_tilda[2, 0]
-    w_k = np.random.multivariate_normal([0, 0, 0], QEst)
+    c = np.cos(pth)
+    s = np.sin(pth)
+    Vx = u_tilda[0, 0] + w_k[0]
+    Vy = u_tilda[1, 0] + w_k[1]
     
-    # Update positions using alpha and beta
-    xPred = np.array([[x_pos + (Vx + w_k[0]) * cos(theta) * dt_pred - (Vy + w_k[1]) * sin(theta) * dt_pred],
-                       [y_pos + (Vx + w_k[0]) * sin(theta) * dt_pred + (Vy + w_k[1]) * cos(theta) * dt_pred],
-                       [angle_wrap(theta) + (omega + w_k[2]) * dt_pred]])
-    return xPred
+    px += (Vx * c - Vy * s) * dt_pred
+    py += (Vx * s + Vy * c) * dt_pred
+    pth[:] = angle_wrap(pth + (u_tilda[2, 0] + w_k[2]) * dt_pred)
+    return x
 
 
 # observation model (h)
 def observation_model(xVeh, iFeature, Map):
-    # xVeh: vehicle state
+    # xVeh: vehicle state, or particles states (one column per particle)
     # iFeature: observed feature index
     # Map: map of all features
     
-    # Extract vehicle state
-    x_veh, y_veh, theta_veh = xVeh[0, 0], xVeh[1, 0], xVeh[2, 0]
-    
     # Extract feature position
-    x_feat, y_feat = Map[0, iFeature], Map[1, iFeature]
+    x_feat, y_feat = Map[:, iFeature]
     
-    dx = x_feat - x_veh
-    dy = y_feat - y_veh
-    range_ = np.sqrt(dx**2 + dy**2)
-    bearing = atan2(dy, dx) - theta_veh
-    bearing = angle_wrap(bearing)
+    dx = x_feat - xVeh[0]
+    dy = y_feat - xVeh[1]
+    range_ = np.hypot(dx, dy)
+    bearing = angle_wrap(np.arctan2(dy, dx) - xVeh[2])
 
-    z = np.array([[range_], [bearing]])
+    z = np.vstack((range_, bearing))
     return z
 
 
 # ---- particle filter implementation ----
 
+# Particle filter step: prediction, weighting and normalization of all particles
+def pf_step(xParticles, wp, u_tilda, z, iFeature, Map, dt_pred, QEst_chol, Rinv_diag):
+    # xParticles: particles states, one column per particle
+    # wp: particles weights
+    # u_tilda: noised control input
+    # z, iFeature: observation and observed feature index (z is None if no observation)
+
+    # do prediction
+    # for each particle we add control vector AND noise
+    xParticles = motion_model(xParticles, u_tilda, dt_pred, QEst_chol)
+
+    if z is not None:
+        # Constants over all particles
+        z0, z1 = z[0, 0], z[1, 0]
+        rinv0, rinv1 = Rinv_diag
+
+        # Predict observation from all the particles positions
+        zPred = observation_model(xParticles, iFeature, Map)
+
+        # Innovation : perception error
+        dr = z0 - zPred[0]
+        dphi = angle_wrap(z1 - zPred[1])
+
+        # Compute particles weights using gaussian model (REst is diagonal)
+        wp = wp * np.exp(-0.5 * (dr * dr * rinv0 + dphi * dphi * rinv1))
+
+    # Normalization
+    wp = wp / np.sum(wp)
+
+    return xParticles, wp
+
+
 # Particle filter resampling
 def re_sampling(px, pw):
     """
@@ -143,54 +177,38 @@ def re_sampling(px, pw):
     """
 
     w_cum = np.cumsum(pw)
-    base = np.arange(0.0, 1.0, 1 / nParticles)
-    re_sample_id = base + np.random.uniform(0, 1 / nParticles)
-    indexes = []
-    ind = 0
-    for ip in range(nParticles):
-        while re_sample_id[ip] > w_cum[ind]:
-            ind += 1
-        indexes.append(ind)
-
-    px = px[:, indexes]
+    w_cum[-1] = 1.0  # guard against round-off in the cumulative sum
+    re_sample_id = (np.arange(nParticles) + np.random.uniform()) / nParticles
+    indexes = np.searchsorted(w_cum, re_sample_id)
+
+    px = np.take(px, indexes, axis=1)  # C-ordered, unlike px[:, indexes]
     # pw = pw[indexes]
     
     # Normalization
-    pw = np.ones(pw.shape)
-    pw = pw / np.sum(pw)
+    pw = np.full(nParticles, 1.0 / nParticles)
 
     return px, pw
 
 def reallocation_resampling(particles, weights):
     M = weights.shape[0]
     N = nParticles
-    n = 0
-    resampled_particles = []
-    resampled_weights = []
-
-    for m in range(M):
-        # Check the weight condition
-        if weights[m] >= 1 / N:
-            N_m_t = int(np.floor(N * weights[m]))  # Calculate how many particles to copy
-            for h in range(N_m_t):
-                n += 1
-                resampled_particles.append(particles[:, m])  # Copy the particle
-                resampled_weights.append(weights[m] / N_m_t)  # Normalize the weight
-        else:
-            u = np.random.uniform(0, 1 / N)  # Sample from uniform distribution
-            if weights[m] >= u:
-                n += 1
-                resampled_particles.append(particles[:, m])  # Copy the particle
-                resampled_weights.append(1 / N)  # Weight is uniform
-
-    while len(resampled_particles) < N:
-        idx = np.random.choice(M)
-        resampled_particles.append(particles[:, idx])
-        resampled_weights.append(1 / N)
-
-    resampled_particles = np.array(resampled_particles).T
-    resampled_weights = np.array(resampled_weights)
-    
+
+    # Particles with weight >= 1/N are copied floor(N * weight) times
+    N_m_t = np.floor(N * weights).astype(int)
+    idx_copy = np.repeat(np.arange(M), N_m_t)
+
+    # Particles with weight < 1/N are kept with probability N * weight
+    u = np.random.uniform(0, 1 / N, M)
+    idx_low = np.where((weights < 1 / N) & (weights >= u))[0]
+
+    # Complete with randomly chosen particles
+    n = idx_copy.size + idx_low.size
+    idx_extra = np.random.choice(M, max(N - n, 0))
+
+    indexes = np.concatenate((idx_copy, idx_low, idx_extra))
+    resampled_particles = np.take(particles, indexes, axis=1)  # C-ordered, unlike particles[:, indexes]
+    resampled_weights = np.full(indexes.size, 1 / N)
+
     return resampled_particles, resampled_weights
 
 
@@ -204,13 +222,9 @@ ax4 = plt.subplot(3, 2, 4)
 ax5 = plt.subplot(3, 2, 6)
 
 
-# fit angle between -pi and pi
+# fit angle (or array of angles) between -pi and pi
 def angle_wrap(a):
-    if (a > np.pi):
-        a = a - 2 * pi
-    elif (a < -np.pi):
-        a = a + 2 * pi
-    return a
+    return (a + pi) % (2 * pi) - pi
 
 
 # composes two transformations
@@ -219,13 +233,16 @@ def tcomp(tab, tbc, dt):
     assert tbc.ndim == 2 # eg: robot control [Vx, Vy, angle rate]
     #dt : time-step (s)
 
-    angle = tab[2, 0] + dt * tbc[2, 0] # angular integration by Euler
+    # scalar computations, a single array is built for the output
+    x, y, theta = tab[0, 0], tab[1, 0], tab[2, 0]
+    vx, vy, omega = tbc[0, 0], tbc[1, 0], tbc[2, 0]
 
-    angle = angle_wrap(angle)
-    s = sin(tab[2, 0])
-    c = cos(tab[2, 0])
-    position = tab[0:2] + dt * np.array([[c, -s], [s, c]]) @ tbc[0:2] # position integration by Euler
-    out = np.vstack((position, angle))
+    angle = angle_wrap(theta + dt * omega) # angular integration by Euler
+    s = sin(theta)
+    c = cos(theta)
+    out = np.array([[x + dt * (c * vx - s * vy)], # position integration by Euler
+                    [y + dt * (s * vx + c * vy)],
+                    [angle]])
 
     return out
 
@@ -241,60 +258,39 @@ def plotParticles(simulation, k, iFeature, hxTrue, hxOdom, hxEst, hxError, hxSTD
     # hxSTD : standard deviation on estimate
     # save : True to save a figure as an image
         
-    # for stopping simulation with the esc key.
-    times = np.stack(htime)
-    plt.gcf().canvas.mpl_connect('key_release_event',
-                lambda event: [exit(0) if event.key == 'escape' else None])
+    times = htime
 
-    ax1.cla()
-
-    # Plot true landmark and trajectory
-    ax1.plot(simulation.Map[0, :], simulation.Map[1, :], "*k")
-    ax1.plot(hxTrue[0, :], hxTrue[1, :], "-k", label="True")
-    if iFeature != None: ax1.plot([simulation.xTrue[0][0], simulation.Map[0, iFeature]], [simulation.xTrue[1][0], simulation.Map[1, iFeature]], "-b")
+    # Plot true trajectory
+    line_true.set_data(hxTrue[0, :], hxTrue[1, :])
+    if iFeature != None: line_feat.set_data([simulation.xTrue[0][0], simulation.Map[0, iFeature]], [simulation.xTrue[1][0], simulation.Map[1, iFeature]])
+    else: line_feat.set_data([], [])
 
     # Plot odometry trajectory
-    ax1.plot(hxOdom[0, :], hxOdom[1, :], "-g", label="Odom")
+    line_odom.set_data(hxOdom[0, :], hxOdom[1, :])
 
     # Plot estimated trajectory and current particles
-    ax1.plot(hxEst[0, :], hxEst[1, :], "-r", label="Part. Filt.")
-    ax1.plot(xEst[0], xEst[1], ".r")
-    ax1.scatter(xParticles[0, :], xParticles[1, :], s=wp*10)
-    for i in range(nParticles):
-        ax1.arrow(xParticles[0, i], xParticles[1, i], 5*np.cos(xParticles[2, i]+np.pi/2), 5*np.sin(xParticles[2, i]+np.pi/2), color = 'orange')
-
-    ax1.axis([-60, 60, -60, 60])
-    ax1.grid(True)
-    ax1.legend()
-
-    #Q6
-    '''
-    ax1.axvline(x=250, color='g', linestyle='--', label='t = 250 s')
-    ax1.axvline(x=350, color='g', linestyle='--', label='t = 350 s')
-    '''
+    line_est.set_data(hxEst[0, :], hxEst[1, :])
+    point_est.set_data(xEst[0], xEst[1])
+    scat_particles.set_offsets(xParticles[0:2, :].T)
+    scat_particles.set_sizes(wp*10)
+    global quiv_particles
+    u_arrows = 5*np.cos(xParticles[2, :]+np.pi/2)
+    v_arrows = 5*np.sin(xParticles[2, :]+np.pi/2)
+    if quiv_particles is None or quiv_particles.N != xParticles.shape[1]:
+        if quiv_particles is not None: quiv_particles.remove()
+        quiv_particles = ax1.quiver(xParticles[0, :], xParticles[1, :], u_arrows, v_arrows, color='orange',
+                                    angles='xy', scale_units='xy', scale=1)
+    else:
+        quiv_particles.set_offsets(xParticles[0:2, :].T)
+        quiv_particles.set_UVC(u_arrows, v_arrows)
 
     # plot errors curves
-    ax3.plot(times, hxError[0, :], 'b')
-    ax3.plot(times,  3.0 * hxSTD[0, :], 'r')
-    ax3.plot(times, - 3.0 * hxSTD[0, :], 'r')
-    ax3.grid(True)
-    ax3.set_ylabel('x (m)')
-    ax3.set_xlabel('time (s)')
-    ax3.set_title(r'Real error (blue) and 3 $\sigma$ covariances (red)')
-
-    ax4.plot(times, hxError[1, :], 'b')
-    ax4.plot(times, 3.0 * hxSTD[1, :], 'r')
-    ax4.plot(times, -3.0 * hxSTD[1, :], 'r')
-    ax4.grid(True)
-    ax4.set_ylabel('y (m)')
-    ax5.set_xlabel('time (s)')
-
-    ax5.plot(times, hxError[2, :], 'b')
-    ax5.plot(times, 3.0 * hxSTD[2, :], 'r')
-    ax5.plot(times, -3.0 * hxSTD[2, :], 'r')
-    ax5.grid(True)
-    ax5.set_ylabel(r"$\theta$ (rad)")
-    ax5.set_xlabel('time (s)')
+    for i, (ax, line_err, line_up, line_down) in enumerate(err_lines):
+        line_err.set_data(times, hxError[i, :])
+        line_up.set_data(times, 3.0 * hxSTD[i, :])
+        line_down.set_data(times, -3.0 * hxSTD[i, :])
+        ax.relim()
+        ax.autoscale_view()
 
     if save: plt.savefig(r'outputs/SRL' + str(k) + '.png')
 #        plt.pause(0.01)
@@ -326,6 +322,8 @@ RTrue = np.diag([0.5, 1*pi/180]) ** 2
 # Modeled errors used in the Particle filter process
 QEst = 2 * np.eye(3, 3) @ QTrue
 REst = 2 * np.eye(2, 2) @ RTrue
+QEst_chol = np.linalg.cholesky(QEst)
+Rinv_diag = 1.0 / np.diag(REst)  # REst is diagonal
 
 # initial conditions
 xTrue = np.array([[1, -50, 0]]).T
@@ -333,7 +331,8 @@ xTrue = np.array([[1, -50, 0]]).T
 xOdom = xTrue
 
 # initial conditions: - a point cloud around truth
-xParticles = xTrue + np.diag([1, 1, 0.1]) @ np.random.randn(3, nParticles)
+# (3, nParticles) C-ordered array: one contiguous row per state component
+xParticles = np.ascontiguousarray(xTrue + np.diag([1, 1, 0.1]) @ np.random.randn(3, nParticles))
 
 # initial conditions: global localization
 #xParticles = 120 * np.random.rand(3, nParticles)-60
@@ -349,27 +348,78 @@ xSTD = np.sqrt(np.average((xParticles-xEst)*(xParticles-xEst),
                axis=1, weights=wp))
 xSTD = np.expand_dims(xSTD, axis=1)
 
+# Simulation environment
+simulation = Simulation(Tf, dt_pred, xTrue, QTrue, xOdom, Map, RTrue, dt_meas)
+
 # Init history matrixes
-hxEst = xEst
-hxTrue = xTrue
-hxOdom = xOdom
+hxEst = np.empty((3, simulation.nSteps))
+hxTrue = np.empty((3, simulation.nSteps))
+hxOdom = np.empty((3, simulation.nSteps))
+hxError = np.empty((3, simulation.nSteps))
+hxSTD = np.empty((3, simulation.nSteps))
+htime = np.empty(simulation.nSteps)
 err = xEst - xTrue
 err[2, 0] = angle_wrap(err[2, 0])
-hxError = err
-hxSTD = xSTD
-htime = [0]
+hxEst[:, 0] = xEst[:, 0]
+hxTrue[:, 0] = xTrue[:, 0]
+hxOdom[:, 0] = xOdom[:, 0]
+hxError[:, 0] = err[:, 0]
+hxSTD[:, 0] = xSTD[:, 0]
+htime[0] = 0
+
+# Init plots: artists are created once and only their data is updated by plotParticles
+if is_plot:
+    # for stopping simulation with the esc key.
+    f.canvas.mpl_connect('key_release_event',
+                lambda event: [exit(0) if event.key == 'escape' else None])
 
-# Simulation environment
-simulation = Simulation(Tf, dt_pred, xTrue, QTrue, xOdom, Map, RTrue, dt_meas)
+    # Plot true landmark and trajectory
+    ax1.plot(Map[0, :], Map[1, :], "*k")
+    line_true, = ax1.plot([], [], "-k", label="True")
+    line_feat, = ax1.plot([], [], "-b")
+
+    # Plot odometry trajectory
+    line_odom, = ax1.plot([], [], "-g", label="Odom")
+
+    # Plot estimated trajectory and current particles
+    line_est, = ax1.plot([], [], "-r", label="Part. Filt.")
+    point_est, = ax1.plot([], [], ".r")
+    scat_particles = ax1.scatter([], [])
+    quiv_particles = None  # created at first plot, as it needs the number of particles
+
+    ax1.axis([-60, 60, -60, 60])
+    ax1.grid(True)
+    ax1.legend()
+
+    #Q6
+    '''
+    ax1.axvline(x=250, color='g', linestyle='--', label='t = 250 s')
+    ax1.axvline(x=350, color='g', linestyle='--', label='t = 350 s')
+    '''
+
+    # plot errors curves
+    err_lines = []
+    for ax in (ax3, ax4, ax5):
+        line_err, = ax.plot([], [], 'b')
+        line_up, = ax.plot([], [], 'r')
+        line_down, = ax.plot([], [], 'r')
+        ax.grid(True)
+        err_lines.append((ax, line_err, line_up, line_down))
+    ax3.set_ylabel('x (m)')
+    ax3.set_xlabel('time (s)')
+    ax3.set_title(r'Real error (blue) and 3 $\sigma$ covariances (red)')
+    ax4.set_ylabel('y (m)')
+    ax5.set_ylabel(r"$\theta$ (rad)")
+    ax5.set_xlabel('time (s)')
 
 # histograma = []
 cmap=mpl.colormaps["Wistia"] #Q4
 
-if is_plot: plotParticles(simulation, 0, None, hxTrue, hxOdom, hxEst, hxError, hxSTD, htime, save = True)
+if is_plot: plotParticles(simulation, 0, None, hxTrue[:, :1], hxOdom[:, :1], hxEst[:, :1], hxError[:, :1], hxSTD[:, :1], htime[:1], save = True)
 
 # Temporal loop
 for k in range(1, simulation.nSteps):
-    htime.append(k*simulation.dt_pred)
+    htime[k] = k*simulation.dt_pred
 #    print(k)
     # Simulate robot motion
     simulation.simulate_world(k)
@@ -377,26 +427,11 @@ for k in range(1, simulation.nSteps):
     # Get odometry measurements
     xOdom, u_tilda = simulation.get_odometry(k)
 
-    # do prediction
-    # for each particle we add control vector AND noise
-    for p in range(nParticles):
-        xParticles[:, p:p+1] = motion_model(xParticles[:, p:p+1], u_tilda, simulation.dt_pred, QEst)
     # observe a random feature
     [z, iFeature] = simulation.get_observation(k)
 
-    if z is not None:
-        for p in range(nParticles):
-            # Predict observation from the particle position
-            zPred = observation_model(xParticles[:, p:p+1], iFeature, simulation.Map)
-
-            # Innovation : perception error
-            Innov = z - zPred
-            Innov[1] = angle_wrap(Innov[1])
-
-            # Compute particle weight using gaussian model
-            wp[p] *= np.exp(-0.5 * Innov.T @ np.linalg.inv(REst) @ Innov).item()
-    # Normalization
-    wp /= np.sum(wp)
+    # do prediction and particles weighting
+    xParticles, wp = pf_step(xParticles, wp, u_tilda, z, iFeature, simulation.Map, simulation.dt_pred, QEst_chol, Rinv_diag)
 
     #print("poids 1 = ", wp)
     
@@ -405,10 +440,8 @@ for k in range(1, simulation.nSteps):
     xEst = np.average(xParticles, axis=1, weights=wp)
     xEst = np.expand_dims(xEst, axis=1)
 
-    # Compute particles std deviation
-    PEst = np.cov(xParticles, aweights=wp, ddof=0) # Empirical covariance matrix
-
-    xSTD = np.sqrt(np.diag(PEst))  # Column vector of standard deviations (sqrt of diagonal of PEst)
+    # Compute particles std deviation (only the diagonal of the empirical covariance is needed)
+    xSTD = np.sqrt(np.average((xParticles-xEst)*(xParticles-xEst), axis=1, weights=wp))
     xSTD = np.expand_dims(xSTD, axis=1)
 
 
@@ -422,17 +455,17 @@ for k in range(1, simulation.nSteps):
         #print("poids 2 = ", wp)
 
     # store data history
-    hxTrue = np.hstack((hxTrue, simulation.xTrue))
-    hxOdom = np.hstack((hxOdom, simulation.xOdom))
-    hxEst = np.hstack((hxEst, xEst))
+    hxTrue[:, k] = simulation.xTrue[:, 0]
+    hxOdom[:, k] = simulation.xOdom[:, 0]
+    hxEst[:, k] = xEst[:, 0]
     err = xEst - simulation.xTrue
     err[2, 0] = angle_wrap(err[2, 0])
-    hxError = np.hstack((hxError, err))
-    hxSTD = np.hstack((hxSTD, xSTD))
+    hxError[:, k] = err[:, 0]
+    hxSTD[:, k] = xSTD[:, 0]
 
     # plot every 20 updates
     if is_plot and k*simulation.dt_pred % 20 == 0:
-        plotParticles(simulation, k, iFeature, hxTrue, hxOdom, hxEst, hxError, hxSTD, htime, save = True)
+        plotParticles(simulation, k, iFeature, hxTrue[:, :k+1], hxOdom[:, :k+1], hxEst[:, :k+1], hxError[:, :k+1], hxSTD[:, :k+1], htime[:k+1], save = True)
     
     '''
     if is_plot and k*simulation.dt_pred % 100 == 0: